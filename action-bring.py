@@ -1,23 +1,54 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
 import configparser
 import importlib
 from BringApi.BringApi import BringApi
+import requests
+from requests.adapters import HTTPAdapter
 from rhasspyhermes.nlu import NluIntent
-from importlib import reload
 from rhasspyhermes_app import EndSession, HermesApp
 import io
+import os
+import threading
 import random
-import sys
 import json
+import logging
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
 
 app = HermesApp("BringApp")
+# debug output is dropped by a level check unless logging is configured
+logger = logging.getLogger("BringApp")
 
 CONFIGURATION_ENCODING_FORMAT = "utf-8"
 # Your Path..
 CONFIG_INI = "/home/pi/skills-server/skills/bring-shopping/config.ini"
+# Seconds between checks whether config.ini was changed
+CONFIG_POLL_INTERVAL = 5
 i18n = importlib.import_module("translations." + "de")
+# Seconds a fetched shopping list is reused before asking Bring! again
+ITEMS_CACHE_TTL = 10
+
+# {list uuid: (expiry, items)}
+_items_cache = {}
+# {list uuid: number of invalidations}, a fetch that started before
+# an invalidation must not store its now outdated result
+_items_generation = {}
+_items_lock = threading.Lock()
+# Upper bound of parallel requests when adding/removing several items
+MAX_WORKERS = 8
+
+# shared BringApi, see get_bring()
+_bring = None
+
+# own generator for picking sentences, saves the random module lookup per call
+_choice = random.Random().choice
 
 class SnipsConfigParser(configparser.ConfigParser):
     def to_dict(self):
@@ -32,93 +63,295 @@ def read_configuration_file(configuration_file):
     except (IOError, configparser.Error) as e:
         return dict()
 
+### Wraps BringApi and reuses get_items() for ITEMS_CACHE_TTL seconds
+# back-to-back intents ("add milk", "add bread") share one request
+class CachedBring:
+    def __init__(self, bring, ttl):
+        self.bring = bring
+        self.ttl = ttl
+
+    def get_items(self):
+        key = self.bring.bringListUUID
+        now = time.monotonic()
+        cached = _items_cache.get(key)
+        if cached and cached[0] > now:
+            return cached[1]
+        generation = _items_generation.get(key, 0)
+        items = self.bring.get_items()
+        with _items_lock:
+            if _items_generation.get(key, 0) == generation:
+                _items_cache[key] = (now + self.ttl, items)
+        return items
+
+    # drop the cached list after we changed it on the server
+    def invalidate(self):
+        key = self.bring.bringListUUID
+        with _items_lock:
+            _items_generation[key] = _items_generation.get(key, 0) + 1
+            _items_cache.pop(key, None)
+
+    def __getattr__(self, name):
+        return getattr(self.bring, name)
+
+### BringApi opens a new connection for every request,
+# this one keeps them alive in a connection pool.
+# requests.Session is not documented as thread-safe, so every thread gets
+# its own session; they all mount the same HTTPAdapter, whose urllib3
+# pool is thread-safe and shares the open connections.
+class SessionBringApi(BringApi):
+    def __init__(self, uuid, bringuuid):
+        super().__init__(uuid, bringuuid)
+        self.adapter = HTTPAdapter(pool_connections=4, pool_maxsize=MAX_WORKERS)
+        self.local = threading.local()
+        # (etag, items) of the last full list response
+        self.last_items = (None, None)
+
+    @property
+    def session(self):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('https://', self.adapter)
+            self.local.session = session
+        return session
+
+    def list_url(self):
+        return f'{self._bringRestURL}bringlists/{self.bringListUUID}'
+
+    # asks with If-None-Match, an unchanged list comes back as 304 without body
+    def get_items(self, locale=None):
+        if locale:
+            return super().get_items(locale)
+        etag, items = self.last_items
+        headers = self.headers
+        if etag:
+            headers = dict(headers, **{'If-None-Match': etag})
+        response = self.session.get(self.list_url(), headers=headers)
+        if response.status_code == 304:
+            return items
+        response.raise_for_status()
+        items = json_loads(response.content)
+        if response.status_code == 200:
+            self.last_items = (response.headers.get('ETag'), items)
+        return items
+
+    def purchase_item(self, item, specification):
+        files = {'file': f'&purchase={item}&recently=&specification={specification}&remove=&sender=null'}
+        return self.session.put(self.list_url(), files=files, headers=self.addheaders)
+
+    def recent_item(self, item):
+        files = {'file': f'&purchase=&recently={item}&specification=&remove=&sender=null'}
+        return self.session.put(self.list_url(), files=files, headers=self.addheaders)
+
+def make_bring(conf):
+    ttl = conf.get('global', {}).get('cache_ttl', ITEMS_CACHE_TTL)
+    try:
+        ttl = float(ttl)
+    except ValueError:
+        logger.warning("invalid cache_ttl %r, using %s", ttl, ITEMS_CACHE_TTL)
+        ttl = ITEMS_CACHE_TTL
+    return CachedBring(SessionBringApi(conf['secret']['uuid'],conf['secret']['bringlistuuid']), ttl)
+
+## Created once, every intent reuses the same connection pool
 def get_bring(conf):
-    return BringApi(conf['secret']['uuid'],conf['secret']['bringlistuuid'])
+    global _bring
+    if _bring is None:
+        _bring = make_bring(conf)
+    return _bring
+
+### (Re)reads config.ini and swaps in a Bring! client built from it
+# a list cached under the old settings is dropped so a new cache_ttl applies at once
+def load_config():
+    global conf, _bring
+    new_conf = read_configuration_file(CONFIG_INI)
+    new_bring = make_bring(new_conf)
+    new_bring.invalidate()
+    _bring = new_bring
+    conf = new_conf
+
+## Like load_config, but a missing or incomplete config.ini is only logged
+def try_load_config():
+    try:
+        load_config()
+    except (KeyError, ValueError) as e:
+        logger.warning("config.ini incomplete, keeping old settings: %s", e)
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
 
-def add_item_int(bring, items):
-    list = bring.get_items()['purchase']
+### Picks up config.ini edits without restarting the skill
+def watch_config():
+    mtime = get_mtime(CONFIG_INI)
+    while True:
+        time.sleep(CONFIG_POLL_INTERVAL)
+        new_mtime = get_mtime(CONFIG_INI)
+        if new_mtime != mtime:
+            mtime = new_mtime
+            try_load_config()
+
+### Coalesces list fetches of intents arriving at the same time
+# the first caller starts get_items() in the executor, everyone else
+# awaits that same future while it is in flight, unless the list was
+# changed since that fetch started
+class ItemsLoader:
+    def __init__(self):
+        self._future = None
+        self._generation = None
+
+    async def load(self, bring):
+        generation = _items_generation.get(bring.bringListUUID, 0)
+        if self._future is None or self._generation != generation:
+            self._future = asyncio.get_running_loop().run_in_executor(None, bring.get_items)
+            self._generation = generation
+            self._future.add_done_callback(self._reset)
+        return await self._future
+
+    def _reset(self, future):
+        if self._future is future:
+            self._future = None
+
+items_loader = ItemsLoader()
+
+## Runs the blocking Bring! calls in the executor so the event loop keeps serving Rhasspy
+async def run_blocking(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+# Intents run as concurrent tasks; add/remove take this lock so one never
+# works on a list another one is still changing. Created on first use so
+# it belongs to the running loop.
+_change_lock = None
+
+def get_change_lock():
+    global _change_lock
+    if _change_lock is None:
+        _change_lock = asyncio.Lock()
+    return _change_lock
+
+# one pool for all multi-item requests, its threads keep their sessions
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+### Calls func for every item, overlapping the network round-trips
+def run_parallel(func, items):
+    if len(items) == 1:
+        func(items[0])
+        return
+    list(_executor.map(func, items))
+
+### {casefolded name: name as written on the list}
+# so "Milch" and "milch" from different recognitions match the same entry
+def get_name_map(purchase):
+    return {entr['name'].casefold(): entr['name'] for entr in purchase}
+
+def add_item_int(bring, items, purchase):
+    names = get_name_map(purchase)
 
     added = []
     exist = []
+    seen = set()
     for item in items:
-        if not any(entr['name'] == item for entr in list):
-            bring.purchase_item(item, "")
+        key = item.casefold()
+        # the same item named twice in one request is only handled once
+        if key in seen:
+            continue
+        seen.add(key)
+        if key not in names:
             added.append(item)
-            print(added)
+            logger.debug("added: %s", item)
         else:
-            exist.append(item)
+            exist.append(names[key])
+    if added:
+        try:
+            run_parallel(lambda item: bring.purchase_item(item, ""), added)
+        finally:
+            bring.invalidate()
     return added, exist
 
-def delete_item_int(bring, items):
-    list = bring.get_items()['purchase']
+def delete_item_int(bring, items, purchase):
+    names = get_name_map(purchase)
     removed = []
     exist = []
     for item in items:
-        if any(entr['name'] == item for entr in list):
-            bring.recent_item(item)
-            removed.append(item)
+        key = item.casefold()
+        if key in names:
+            removed.append(names[key])
         else:
             exist.append(item)
+    if removed:
+        try:
+            run_parallel(bring.recent_item, removed)
+        finally:
+            bring.invalidate()
     return removed, exist
 
-def check_list_int(bring,check):
-    list = bring.get_items()['purchase']
+def check_list_int(bring, check, purchase):
+    names = get_name_map(purchase)
     found = []
     missing = []
     for c in check:
-        if any(c == entr['name'] for entr in list):
-            found.append(c)
+        key = c.casefold()
+        if key in names:
+            found.append(names[key])
         else:
             missing.append(c)
     return found, missing
 
 
 ### INTENTS ###
-## Add item to list
-def add_item(intentMessage,conf):
-    itemsList = []
-    for slot in intentMessage.slots:
-        if slot.slot_name == "Items":
-            itemsList.append(slot.raw_value)
-
-    if len(itemsList) > 0:
-        added, exist = add_item_int(get_bring(conf), itemsList)
-        return combine_lists(i18n.ADD, i18n.ADD_CONN, i18n.ADD_END, i18n.ADD_F, added, exist)
+## Raw values of all "Items" slots
+def get_slot_items(intentMessage):
+    return [slot.raw_value for slot in intentMessage.slots if slot.slot_name == "Items"]
+
+## Sentences per item intent: (done, connector, end, failed, nothing given)
+_STR_TABLE = {
+    "ADD": (i18n.ADD, i18n.ADD_CONN, i18n.ADD_END, i18n.ADD_F, i18n.ADD_WHAT),
+    "REM": (i18n.REM, i18n.REM_CONN, i18n.REM_END, i18n.REM_F, i18n.REM_WHAT),
+    "CHK": (i18n.CHK, i18n.CHK_CONN, i18n.CHK_END, i18n.CHK_F, i18n.CHK_WHAT),
+}
+# keys of the intents that change the list
+_CHANGING = ("ADD", "REM")
+_READ = i18n.READ
+_GENERAL_LIST = i18n.GENERAL_LIST
+
+async def run_on_list(op, bring, itemsList):
+    purchase = (await items_loader.load(bring))['purchase']
+    return await run_blocking(op, bring, itemsList, purchase)
+
+## Runs op on the spoken items and builds the answer from the key's sentences
+# the list is only fetched if there is something to look up
+async def handle_items(intentMessage, conf, op, key):
+    strs = _STR_TABLE[key]
+    itemsList = get_slot_items(intentMessage)
+    if not itemsList:
+        return _choice(strs[4])
+    bring = get_bring(conf)
+    if key in _CHANGING:
+        async with get_change_lock():
+            first, second = await run_on_list(op, bring, itemsList)
     else:
-        return random.choice(i18n.ADD_WHAT)
+        first, second = await run_on_list(op, bring, itemsList)
+    return combine_lists(strs[0], strs[1], strs[2], strs[3], first, second)
+
+## Add item to list
+async def add_item(intentMessage,conf):
+    return await handle_items(intentMessage, conf, add_item_int, "ADD")
 
 ## Delete items from list
-def delete_item(intentMessage,conf):
-    itemsList = []
-    for slot in intentMessage.slots:
-        if slot.slot_name == "Items":
-            itemsList.append(slot.raw_value)
-
-    if len(itemsList) > 0:
-        removed, failed = delete_item_int(get_bring(conf), itemsList)
-        return combine_lists(i18n.REM, i18n.REM_CONN, i18n.REM_END, i18n.REM_F, removed, failed)
-    else:
-        return random.choice(i18n.REM_WHAT)
+async def delete_item(intentMessage,conf):
+    return await handle_items(intentMessage, conf, delete_item_int, "REM")
 
 ## check if item is in list
-def check_list(intentMessage,conf):
-    itemsList = []
-    for slot in intentMessage.slots:
-        if slot.slot_name == "Items":
-            itemsList.append(slot.raw_value)
-
-    if len(itemsList) > 0:
-        found, missing = check_list_int(get_bring(conf), itemsList)
-        return combine_lists(i18n.CHK, i18n.CHK_CONN, i18n.CHK_END, i18n.CHK_F, found, missing)
-    else:
-        return random.choice(i18n.CHK_WHAT)
+async def check_list(intentMessage,conf):
+    return await handle_items(intentMessage, conf, check_list_int, "CHK")
 
 # Du hast xxx, xxx und xxx auf deiner Einkaufsliste
-def read_list(conf):
-    items = get_bring(conf).get_items()['purchase']
+async def read_list(conf):
+    items = (await items_loader.load(get_bring(conf)))['purchase']
     itemlist = [ l['name'] for l in items ]
-    print(itemlist)
-    return get_text_for_list(i18n.READ, itemlist)
+    logger.debug("list: %s", itemlist)
+    return get_text_for_list(_READ, itemlist)
 
 
 #### List/Text operations
@@ -134,23 +367,22 @@ def combine_lists(str_first, str_conn, str_end, str_second, first, second):
         backup = strout # don't overwrite added list... even if empty!
         strout = get_text_for_list(str_second,second)
     else:
-        strout += random.choice(str_end)
+        strout += _choice(str_end)
     
     if first and second:
-        strout = random.choice(str_conn).format(backup,strout)
+        strout = _choice(str_conn).format(backup,strout)
     return strout
 
 ### Combine entries of list into wrapper sentence
 def get_text_for_list(str,list):
     category, strout = get_default_list(list)
-    print(str)
-    print(category)
-    return random.choice(str[category]).format(strout)
+    logger.debug("%s: %s", category, str)
+    return _choice(str[category]).format(strout)
 
 ### Return if MULTI or ONE entry and creates list for multi ( XXX, XXX and XXX )
 def get_default_list(items):
     if len(items) > 1:
-        return "MULTI", random.choice(i18n.GENERAL_LIST).format(first=", ".join(items[:-1]), last=items[-1])
+        return "MULTI", _choice(_GENERAL_LIST).format(first=", ".join(items[:-1]), last=items[-1])
     elif len(items) == 1:
         return "ONE", items[0]
     else:
@@ -160,26 +392,25 @@ def get_default_list(items):
 @app.on_intent(i18n.INTENT_ADD_ITEM)
 async def addItem(intent: NluIntent):
     """Add Item"""
-    return EndSession(add_item(intent,conf))
+    return EndSession(await add_item(intent, conf))
 
 @app.on_intent(i18n.INTENT_DEL_ITEM)
 async def delItem(intent: NluIntent):
     """del item"""
-    return EndSession(delete_item(intent,conf))
+    return EndSession(await delete_item(intent, conf))
 
 @app.on_intent(i18n.INTENT_READ_LIST)
 async def readList(intent: NluIntent):
     """Read list"""
-    return EndSession(read_list(conf))
+    return EndSession(await read_list(conf))
 
 @app.on_intent(i18n.INTENT_CHECK_LIST)
 async def checkList(intent: NluIntent):
     """Check List"""
-    return EndSession(check_list(intent,conf))
+    return EndSession(await check_list(intent, conf))
 
 if __name__ == "__main__":
-   # reload(sys)
-   # sys.setdefaultencoding('utf-8')
-    conf = read_configuration_file(CONFIG_INI)
-    i18n = importlib.import_module("translations." + "de")
+    conf = dict()
+    try_load_config()
+    threading.Thread(target=watch_config, daemon=True).start()
     app.run()